@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''Measures how MapFuse read throughput scales with the number of
+threads reading at once.  The reads go straight to MapFuse's readinto,
+in process, as FUSE's read callback would make them, so no mount is
+needed.  (Through read_buf, libfuse splices the data from the real file
+without it passing through Python; measuring that takes a mount.)  Put
+the files (--dir) on the storage you care about; on a page-cached tmpfs
+the numbers mostly show CPU scaling.'''
+
+from __future__ import with_statement
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from ctypes import create_string_buffer
+from threading import Thread
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from mapperfs import MapFuse
+from fuse import fuse_file_info
+
+def reader(mapfuse, files, block, deadline, totals, i):
+    rand = random.Random(i)
+    fis = []
+    for mounted, size in files:
+        fi = fuse_file_info()
+        fi.flags = os.O_RDONLY
+        mapfuse('open', mounted, fi)
+        fis.append((mounted, size, fi))
+    buf = create_string_buffer(block)
+    total = 0
+    while time.time() < deadline:
+        mounted, size, fi = rand.choice(fis)
+        offset = rand.randrange(0, size - block + 1, block)
+        total += mapfuse('readinto', mounted, buf, block, offset, fi)
+    for mounted, size, fi in fis:
+        mapfuse('release', mounted, fi)
+    totals[i] = total
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024,
+                        help='bytes per file')
+    parser.add_argument('--block', type=int, default=128 * 1024,
+                        help='bytes per read')
+    parser.add_argument('--seconds', type=float, default=3.0,
+                        help='how long to read for at each thread count')
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help='thread counts to try')
+    parser.add_argument('--dir', help='where to put the files to read')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(dir=args.dir)
+    try:
+        pairs = []
+        for n in range(args.files):
+            real = os.path.join(top, 'file%d' % n)
+            with open(real, 'wb') as f:
+                for done in xrange(0, args.size, 1024 * 1024):
+                    f.write(os.urandom(min(1024 * 1024, args.size - done)))
+            pairs.append((real, '/file%d' % n))
+        mapfuse = MapFuse(lambda: pairs, [])
+        files = [(mounted, args.size) for real, mounted in pairs]
+        for threads in [int(n) for n in args.threads.split(',')]:
+            totals = [0] * threads
+            deadline = time.time() + args.seconds
+            workers = [Thread(target=reader, args=(mapfuse, files, args.block,
+                                                   deadline, totals, i))
+                       for i in range(threads)]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - start
+            print '%2d threads: %8.1f MB/s' % (threads,
+                                               sum(totals) / elapsed / 1e6)
+    finally:
+        shutil.rmtree(top)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+'''Times FlatMapper on lists where most files share a few names, as in
+a flat mount of camera dumps full of IMG_0001.JPG and friends.'''
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from mapperfs import FlatMapper
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', default='20000,100000,300000',
+                        help='numbers of files to try')
+    parser.add_argument('--names', type=int, default=3,
+                        help='how many distinct file names they share')
+    args = parser.parse_args()
+
+    for n in [int(size) for size in args.sizes.split(',')]:
+        files = ['/dump%d/IMG_%04d.JPG' % (i, i % args.names + 1)
+                 for i in xrange(n)]
+        start = time.time()
+        pairs = list(FlatMapper().pairs(files))
+        elapsed = time.time() - start
+        assert len(set(mounted for real, mounted in pairs)) == n
+        print '%8d files: %7.3f s, %5.2f us per file' % (n, elapsed,
+                                                         elapsed * 1e6 / n)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''Measures how much memory MapFuse's index takes per mapped file, for
+a synthetic music library.  It reports both the size of the index's
+objects and how much the process grew while building it.'''
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from mapperfs import MapFuse, TrivialMapper, FlatMapper, CommonMapper
+
+mappers = {'copy': TrivialMapper,
+           'flat': FlatMapper,
+           'common': CommonMapper }
+
+def library(n):
+    '''Yields n paths, 20 to an album and 50 albums to an artist.'''
+    for i in xrange(n):
+        yield ('/home/user/media/music/artist%04d/album%02d/'
+               '%05d - track title %d.flac'
+               % (i // 1000, i // 20 % 50, i, i % 13))
+
+def rss_kb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def deep_size(top):
+    '''Return the bytes taken by top and everything it refers to.'''
+    seen = set()
+    stack = [top]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif not isinstance(obj, (basestring, int, long, float, type)):
+            for slot in getattr(type(obj), '__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+    return total
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--mapper', choices=mappers.keys(),
+                        default='copy')
+    parser.add_argument('-n', '--files', type=int, default=1000000)
+    args = parser.parse_args()
+
+    mapper = mappers[args.mapper]()
+    before = rss_kb()
+    mapfuse = MapFuse(lambda: mapper.pairs(library(args.files)), [],
+                      attr_ttl=0, max_open=0)
+    gc.collect()
+    grown = (rss_kb() - before) * 1024.0
+    print '%s, %d files: index %.0f bytes/file, process %.0f bytes/file' % (
+        args.mapper, args.files, deep_size(mapfuse.index) / float(args.files),
+        grown / args.files)
+
+if __name__ == '__main__':
+    main()
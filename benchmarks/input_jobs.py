@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''Times InputFiles reading the same lists with one job and with more,
+both as many small lists and as one big one.'''
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from mapperfs import InputFiles
+
+def write_list(name, first, n):
+    with open(name, 'w') as f:
+        for i in xrange(first, first + n):
+            f.write('"/music/artist%d/album%d/track%d.mp3"\n' %
+                    (i // 1000, i // 10, i))
+
+def time_read(names, jobs):
+    inputs = InputFiles(names, jobs)
+    try:
+        start = time.time()
+        n = sum(1 for line in inputs.read())
+        return n, time.time() - start
+    finally:
+        inputs.close()
+
+def main():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--lines', type=int, default=1000000,
+                        help='lines in all the lists together')
+    parser.add_argument('--files', type=int, default=16,
+                        help='how many lists to split them between')
+    parser.add_argument('--jobs', default='1,2,4',
+                        help='numbers of jobs to try')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp()
+    try:
+        per_file = args.lines // args.files
+        many = [os.path.join(top, 'list%d' % i) for i in xrange(args.files)]
+        for i, name in enumerate(many):
+            write_list(name, i * per_file, per_file)
+        one = [os.path.join(top, 'all')]
+        write_list(one[0], 0, per_file * args.files)
+
+        for label, names in (('%d lists' % args.files, many),
+                             ('one list', one)):
+            for jobs in [int(n) for n in args.jobs.split(',')]:
+                n, elapsed = time_read(names, jobs)
+                print '%-10s %2d jobs: %7.3f s, %5.2f us per line' % (
+                    label, jobs, elapsed, elapsed * 1e6 / n)
+    finally:
+        shutil.rmtree(top)
+
+if __name__ == '__main__':
+    main()
@@ -248,6 +248,31 @@ class fuse_context(Structure):
 
 _libfuse.fuse_get_context.restype = POINTER(fuse_context)
 
+# libfuse frees the buffers read_buf hands back, so they must come from malloc
+_libc = CDLL(find_library('c'))
+_libc.malloc.argtypes = [c_size_t]
+_libc.malloc.restype = c_void_p
+_libc.free.argtypes = [c_void_p]
+
+FUSE_BUF_IS_FD = 1 << 1
+FUSE_BUF_FD_SEEK = 1 << 2
+FUSE_BUF_FD_RETRY = 1 << 3
+
+class fuse_buf(Structure):
+    _fields_ = [
+        ('size', c_size_t),
+        ('flags', c_int),
+        ('mem', c_void_p),
+        ('fd', c_int),
+        ('pos', c_off_t)]
+
+class fuse_bufvec(Structure):
+    _fields_ = [
+        ('count', c_size_t),
+        ('idx', c_size_t),
+        ('off', c_size_t),
+        ('buf', fuse_buf * 1)]
+
 
 class fuse_operations(Structure):
     _fields_ = [
@@ -311,6 +336,21 @@ class fuse_operations(Structure):
 
         ('utimens', CFUNCTYPE(c_int, c_char_p, POINTER(c_utimbuf))),
         ('bmap', CFUNCTYPE(c_int, c_char_p, c_size_t, POINTER(c_ulonglong))),
+
+        # Everything from here on needs libfuse 2.9; older versions ignore it.
+        ('flag_nullpath_ok', c_uint, 1),
+        ('flag_nopath', c_uint, 1),
+        ('flag_utime_omit_ok', c_uint, 1),
+        ('flag_reserved', c_uint, 29),
+        ('ioctl', c_voidp),
+        ('poll', c_voidp),
+        ('write_buf', c_voidp),
+
+        ('read_buf', CFUNCTYPE(c_int, c_char_p, POINTER(POINTER(fuse_bufvec)),
+                               c_size_t, c_off_t, POINTER(fuse_file_info))),
+
+        ('flock', c_voidp),
+        ('fallocate', c_voidp),
     ]
 
 
@@ -366,6 +406,8 @@ class FUSE(object):
 
         self.operations = operations
         self.raw_fi = raw_fi
+        self.readinto = bool(getattr(operations, 'readinto', None))
+        self.paged_readdir = getattr(operations, 'paged_readdir', False)
         self.encoding = encoding
 
         args = ['fuse']
@@ -382,7 +424,8 @@ class FUSE(object):
         argv = (c_char_p * len(args))(*args)
 
         fuse_ops = fuse_operations()
-        for name, prototype in fuse_operations._fields_:
+        for field in fuse_operations._fields_:
+            name, prototype = field[:2]
             if prototype != c_voidp and getattr(operations, name, None):
                 op = partial(self._wrapper, getattr(self, name))
                 setattr(fuse_ops, name, prototype(op))
@@ -496,6 +539,10 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
+        if self.readinto:
+            return self.operations('readinto', path.decode(self.encoding),
+                                               buf, size, offset, fh)
+
         ret = self.operations('read', path.decode(self.encoding), size,
                                       offset, fh)
 
@@ -505,10 +552,47 @@ class FUSE(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
         memmove(buf, ret, retsize)
         return retsize
 
+    def read_buf(self, path, bufp, size, offset, fip):
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        ret = self.operations('read_buf', path.decode(self.encoding), size,
+                                          offset, fh)
+
+        bufvec = cast(_libc.malloc(sizeof(fuse_bufvec)), POINTER(fuse_bufvec))
+        if not bufvec: return -ENOMEM
+        memset(bufvec, 0, sizeof(fuse_bufvec))
+
+        vec = bufvec.contents
+        vec.count = 1
+        buf = vec.buf[0]
+
+        if isinstance(ret, (int, long)):
+            # let libfuse read (or splice) straight from the descriptor
+            buf.size = size
+            buf.flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK
+            buf.fd = ret
+            buf.pos = offset
+        elif ret:
+            retsize = len(ret)
+            assert retsize <= size, \
+                'actual amount read %d greater than expected %d' % (retsize,
+                                                                     size)
+            buf.mem = _libc.malloc(retsize)
+            if not buf.mem:
+                _libc.free(bufvec)
+                return -ENOMEM
+            memmove(buf.mem, ret, retsize)
+            buf.size = retsize
+
+        bufp[0] = bufvec
+        return 0
+
     def write(self, path, buf, size, offset, fip):
         data = string_at(buf, size)
 
@@ -604,8 +688,11 @@ class FUSE(object):
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path.decode(self.encoding),
-                                               fip.contents.fh):
+        args = [path.decode(self.encoding), fip.contents.fh]
+        if self.paged_readdir:
+            args.append(offset)
+
+        for item in self.operations('readdir', *args):
 
             if isinstance(item, basestring):
                 name, st, offset = item, None, 0
@@ -825,6 +912,24 @@ class Operations(object):
 
         return ['.', '..']
 
+    # Set paged_readdir to have readdir called as readdir(path, fh, offset),
+    # so that large directories can be listed a bufferful at a time.  It
+    # should then return (name, attrs, offset) tuples starting at the given
+    # offset, each offset being the one to resume from after that entry.
+    paged_readdir = False
+
+    # Operations may define read_buf(path, size, offset, fh) to answer
+    # reads without copying data through Python (requires libfuse 2.9).
+    # Returning a file descriptor makes libfuse read the data from it at
+    # offset, splicing when it can; returning a string serves that
+    # string instead.  When defined, libfuse uses it in place of read.
+    read_buf = None
+
+    # Operations may define readinto(path, buf, size, offset, fh) instead
+    # of read.  It should copy the data directly into buf, a ctypes
+    # pointer to the kernel's buffer, and return the number of bytes read.
+    readinto = None
+
     def readlink(self, path):
         raise FuseOSError(ENOENT)
 
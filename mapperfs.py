@@ -19,13 +19,24 @@
 from __future__ import with_statement
 
 from errno import EACCES, ENOENT
-from threading import Thread, Lock
-from collections import defaultdict
-from itertools import izip
+from resource import getrusage, RUSAGE_SELF
+from threading import Thread, Lock, Event
+from collections import Counter, OrderedDict
+from ctypes import (CDLL, c_char_p, c_int, c_int64, c_size_t, c_ssize_t,
+                    c_void_p, create_string_buffer, get_errno, memmove,
+                    string_at)
+from ctypes.util import find_library
+from itertools import chain, count, izip
+from Queue import Queue
+from mmap import MAP_SHARED, PROT_READ
+from multiprocessing import Pool
+from types import GeneratorType
 import stat
 import logging
 import fileinput
+import marshal
 import os
+import sys
 import time
 
 # https://github.com/terencehonles/fusepy
@@ -36,89 +47,1344 @@ try:
 except ImportError:
     logging.warning('inotifyx module not found; file watching not supported')
 
-class Directory(set):
-    def num_subdirs(self):
-        return sum(1 for e in self if isinstance(e, Directory))
+# os.pread and os.pwrite only arrived in Python 3.3.
+_libc = CDLL(find_library('c'), use_errno=True)
+_pread = getattr(_libc, 'pread64', None) or _libc.pread
+_pread.argtypes = [c_int, c_void_p, c_size_t, c_int64]
+_pread.restype = c_ssize_t
+_pwrite = getattr(_libc, 'pwrite64', None) or _libc.pwrite
+_pwrite.argtypes = [c_int, c_char_p, c_size_t, c_int64]
+_pwrite.restype = c_ssize_t
+
+# Likewise posix_fadvise, which not every libc has.
+_fadvise = (getattr(_libc, 'posix_fadvise64', None) or
+            getattr(_libc, 'posix_fadvise', None))
+if _fadvise is not None:
+    _fadvise.argtypes = [c_int, c_int64, c_int64, c_int]
+POSIX_FADV_WILLNEED = 3
+
+# Python 2's mmap objects can't be viewed without copying, so we map
+# files ourselves and copy straight out of the mapped address.
+_mmap = getattr(_libc, 'mmap64', None) or _libc.mmap
+_mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_int, c_int64]
+_mmap.restype = c_void_p
+_munmap = _libc.munmap
+_munmap.argtypes = [c_void_p, c_size_t]
+MAP_FAILED = c_void_p(-1).value
+
+def _check(ret):
+    if ret < 0:
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ret
+
+def pread(fd, size, offset):
+    '''Read up to size bytes from fd at offset, leaving the file
+    position alone.'''
+    buf = create_string_buffer(size)
+    return string_at(buf, _check(_pread(fd, buf, size, offset)))
+
+def pwrite(fd, data, offset):
+    '''Write data to fd at offset, leaving the file position alone.'''
+    return _check(_pwrite(fd, data, len(data), offset))
+
+# When to sync writes to the backing files: never, only when asked to
+# with fsync/fdatasync, or also whenever a writable file is closed.
+DURABILITY_POLICIES = ('none', 'fsync-on-fsync', 'strict')
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+# Open flags that make a handle something other than read-only
+_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC
+
+class Directory(dict):
+    '''A directory we synthesized to reach the mapped entries.  Maps
+    each name it contains to the node for that name in the index.  It
+    also keeps count of how many of those are synthesized directories,
+    and when names were last added or removed.  How many are mapped to
+    real directories is only worked out when first asked for.'''
+    __slots__ = ('subdirs', 'mtime', 'entry_dirs')
+
+    def __init__(self, mtime, children=()):
+        dict.__init__(self, children)
+        self.mtime = mtime
+        self.subdirs = sum(1 for node in self.itervalues()
+                           if isinstance(node, Directory))
+        self.entry_dirs = None
+
+    def copy(self):
+        node = Directory(self.mtime)
+        node.update(self)
+        node.subdirs = self.subdirs
+        return node
+
+    def nlink(self):
+        '''Return the link count: one for each subdirectory, plus two.
+        The first call stats the real path of every entry whose type we
+        don't know yet, so the index build never has to.'''
+        if self.entry_dirs is None:
+            n = 0
+            for node in self.itervalues():
+                if isinstance(node, Entry):
+                    if node.isdir is None:
+                        node.isdir = os.path.isdir(node.real)
+                    n += node.isdir
+            self.entry_dirs = n
+        return 2 + self.subdirs + self.entry_dirs
+
+class Entry(object):
+    '''A mapped entry in the index.  Its children, if any, are nodes for
+    other entries mapped beneath it, not the contents of its real path.
+
+    The real path is kept in two parts: the directory, which is shared
+    with every other entry from the same directory, and the name.
+    isdir records whether the real path is a directory, once someone
+    has needed to know (it's None until then).'''
+    __slots__ = ('prefix', 'suffix', 'children', 'isdir')
+
+    def __init__(self, real, children=None, isdir=None):
+        i = real.rfind('/') + 1
+        self.prefix = _intern(real[:i])
+        self.suffix = real[i:]
+        self.children = children
+        self.isdir = isdir
+
+    @property
+    def real(self):
+        return self.prefix + self.suffix
+
+def _intern(s):
+    '''Return the one shared copy of s.  We only intern strings that
+    are likely to repeat (directories, not file names), since the
+    interned table costs memory for every string in it.'''
+    return intern(s) if type(s) is str else s
+
+def _components(path):
+    return [name for name in path.split('/') if name]
+
+def _children(node):
+    '''Return the dict of names beneath an index node, or None.'''
+    if isinstance(node, Directory):
+        return node
+    return node.children
+
+class AttrCache(object):
+    '''A bounded LRU cache of getattr results, keyed by real path.
+    Results expire ttl seconds after they were fetched.'''
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.lock = Lock()
+        self.attrs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        with self.lock:
+            cached = self.attrs.pop(path, None)
+            if cached is not None and cached[0] > time.time():
+                self.attrs[path] = cached    # now the most recently used
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+    def peek(self, path):
+        '''Return the cached attributes for path if they're still good,
+        without counting a hit or a miss.'''
+        with self.lock:
+            cached = self.attrs.get(path)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+
+    def put(self, path, attrs):
+        with self.lock:
+            self.attrs.pop(path, None)
+            self.attrs[path] = (time.time() + self.ttl, attrs)
+            while len(self.attrs) > self.size:
+                self.attrs.popitem(last=False)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.attrs.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.attrs.clear()
+
+    def counters(self):
+        with self.lock:
+            return { 'hits' : self.hits,
+                     'misses' : self.misses,
+                     'entries' : len(self.attrs) }
+
+class ContentCache(object):
+    '''A byte-budgeted LRU cache of the contents of small real files,
+    keyed by real path.  Each is stored along with the version of the
+    file it was read from, and only returned for that version.'''
+    def __init__(self, budget, max_size):
+        self.budget = budget
+        self.max_size = max_size
+        self.lock = Lock()
+        self.files = OrderedDict()  # path -> (version, data)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, version):
+        with self.lock:
+            cached = self.files.pop(path, None)
+            if cached is not None:
+                if cached[0] == version:
+                    self.files[path] = cached
+                    self.hits += 1
+                    return cached[1]
+                self.used -= len(cached[1])
+            self.misses += 1
+
+    def put(self, path, version, data):
+        if len(data) > self.max_size or len(data) > self.budget:
+            return
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old is not None:
+                self.used -= len(old[1])
+            self.files[path] = (version, data)
+            self.used += len(data)
+            while self.used > self.budget:
+                path, (version, data) = self.files.popitem(last=False)
+                self.used -= len(data)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        with self.lock:
+            cached = self.files.pop(path, None)
+            if cached is not None:
+                self.used -= len(cached[1])
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.used = 0
+
+    def counters(self):
+        with self.lock:
+            return { 'hits' : self.hits,
+                     'misses' : self.misses,
+                     'evictions' : self.evictions,
+                     'entries' : len(self.files),
+                     'bytes' : self.used }
+
+class _PooledFile(object):
+    __slots__ = ('fd', 'key', 'version', 'refs')
+
+    def __init__(self, fd, key, version):
+        self.fd = fd
+        self.key = key
+        self.version = version
+        self.refs = 1
+
+class FilePool(object):
+    '''Shares read-only descriptors for the real files among all the
+    handles open on them.  A descriptor nobody is using stays open in
+    case it's wanted again, until there are more than max_open such
+    idle ones; then the least recently used are closed.'''
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.lock = Lock()
+        self.files = {}             # (path, flags) -> _PooledFile
+        self.fds = {}               # fd -> _PooledFile
+        self.idle = OrderedDict()   # (path, flags) -> _PooledFile
+
+    def acquire(self, path, flags, version=None):
+        '''Return a descriptor for path opened with flags.  version
+        identifies the file now at path; if it's not the one we have
+        open, we open it afresh.  With no version, whatever we have open
+        is taken to be current.'''
+        key = (path, flags)
+        with self.lock:
+            pooled = self.files.get(key)
+            if pooled is not None:
+                if version is None or pooled.version == version:
+                    pooled.refs += 1
+                    self.idle.pop(key, None)
+                    return pooled.fd
+                self._drop(pooled)
+        fd = os.open(path, flags)
+        with self.lock:
+            if key not in self.files:
+                pooled = self.files[key] = _PooledFile(fd, key, version)
+                self.fds[fd] = pooled
+        return fd
+
+    def release(self, fd):
+        with self.lock:
+            pooled = self.fds.get(fd)
+            if pooled is None:
+                os.close(fd)
+                return
+            pooled.refs -= 1
+            if pooled.refs:
+                return
+            if self.files.get(pooled.key) is not pooled:
+                del self.fds[fd]
+                os.close(fd)
+                return
+            self.idle[pooled.key] = pooled
+            while len(self.idle) > self.max_open:
+                key, pooled = self.idle.popitem(last=False)
+                self._drop(pooled)
+
+    def _drop(self, pooled):
+        '''Stop handing out pooled.fd, closing it once it's not in use.'''
+        del self.files[pooled.key]
+        self.idle.pop(pooled.key, None)
+        if not pooled.refs:
+            del self.fds[pooled.fd]
+            os.close(pooled.fd)
+
+    def invalidate(self, path):
+        with self.lock:
+            for key, pooled in self.files.items():
+                if key[0] == path:
+                    self._drop(pooled)
+
+    def clear(self):
+        with self.lock:
+            for pooled in self.files.values():
+                self._drop(pooled)
+
+class _Mapping(object):
+    __slots__ = ('path', 'version', 'fd', 'addr', 'size', 'refs', 'dropped')
+
+    def __init__(self, path, version, fd, addr, size):
+        self.path = path
+        self.version = version
+        self.fd = fd
+        self.addr = addr
+        self.size = size
+        self.refs = 1
+        self.dropped = False
+
+class FileMaps(object):
+    '''Maps real files of at least min_size bytes into memory, sharing
+    each map among all the handles open on the file, with no more than
+    limit bytes mapped at once.  A map goes away when the last handle
+    using it is released.
+
+    Touching a mapped page past the end of a file that has shrunk kills
+    us with SIGBUS, so reads check the file's current size first, unless
+    watched() says any change to it will reach invalidate(), in which
+    case we only check once it has.  Either way a file shrinking between
+    the check and the copy still kills us, so don't map files that are
+    being modified in place.'''
+    def __init__(self, limit, min_size, watched=lambda: False):
+        self.limit = limit
+        self.min_size = min_size
+        self.watched = watched
+        self.lock = Lock()
+        self.maps = {}      # path -> _Mapping
+        self.mapped = 0
+
+    def acquire(self, path, st):
+        '''Return a _Mapping of the real file path, whose stat is st, or
+        None if it shouldn't or can't be mapped.'''
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+            return None
+        version = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        with self.lock:
+            mapping = self.maps.get(path)
+            if mapping is not None:
+                if mapping.version == version:
+                    mapping.refs += 1
+                    return mapping
+                self._drop(mapping)
+            if self.mapped + st.st_size > self.limit:
+                return None
+            fd = os.open(path, os.O_RDONLY)
+            addr = _mmap(None, st.st_size, PROT_READ, MAP_SHARED, fd, 0)
+            if addr == MAP_FAILED:
+                logging.info('cannot map %s: %s'
+                             % (path, os.strerror(get_errno())))
+                os.close(fd)
+                return None
+            mapping = self.maps[path] = _Mapping(path, version, fd, addr,
+                                                 st.st_size)
+            self.mapped += st.st_size
+            return mapping
+
+    def release(self, mapping):
+        with self.lock:
+            mapping.refs -= 1
+            if not mapping.refs:
+                if self.maps.get(mapping.path) is mapping:
+                    del self.maps[mapping.path]
+                self._unmap(mapping)
+
+    def _drop(self, mapping):
+        '''Stop handing out mapping, unmapping it once it's not in use.'''
+        del self.maps[mapping.path]
+        mapping.dropped = True
+        if not mapping.refs:
+            self._unmap(mapping)
+
+    def _unmap(self, mapping):
+        _munmap(mapping.addr, mapping.size)
+        os.close(mapping.fd)
+        self.mapped -= mapping.size
+
+    def _span(self, mapping, size, offset):
+        '''Return how many bytes at offset can be copied from mapping,
+        or None if they have to be read from the file instead.'''
+        if not mapping.dropped and self.watched():
+            return max(min(offset + size, mapping.size) - offset, 0)
+        current = os.fstat(mapping.fd).st_size
+        if current < mapping.size:
+            # Shrunk: let later opens map what's there now.
+            with self.lock:
+                if self.maps.get(mapping.path) is mapping:
+                    self._drop(mapping)
+        end = min(offset + size, current)
+        if end > mapping.size:
+            return None
+        return max(end - offset, 0)
+
+    def read(self, mapping, size, offset):
+        n = self._span(mapping, size, offset)
+        if n is None:
+            return pread(mapping.fd, size, offset)
+        return string_at(mapping.addr + offset, n)
+
+    def readinto(self, mapping, buf, size, offset):
+        n = self._span(mapping, size, offset)
+        if n is None:
+            return _check(_pread(mapping.fd, buf, size, offset))
+        memmove(buf, mapping.addr + offset, n)
+        return n
+
+    def invalidate(self, path):
+        with self.lock:
+            mapping = self.maps.get(path)
+            if mapping is not None:
+                self._drop(mapping)
+
+    def clear(self):
+        with self.lock:
+            for mapping in self.maps.values():
+                self._drop(mapping)
+
+class _Stream(object):
+    '''What a Prefetcher knows about reads through one handle.'''
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        self.size = os.fstat(fd).st_size   # no reading ahead past this
+        self.next = None    # where the next read starts if sequential
+        self.run = 0        # how many sequential reads in a row
+        self.ahead = 0      # where reading ahead has got to
+        self.chunks = {}    # offset -> data, or None until it's read
+
+class Prefetcher(object):
+    '''Reads ahead of handles that are being read sequentially.
+
+    Once a handle has seen sequential_reads reads in a row, we ask the
+    kernel to start fetching the next window bytes, and worker threads
+    read them into chunks of chunk_size, so the reads that follow don't
+    have to wait on the backing store.  All the chunks held together
+    stay within budget bytes.  A read anywhere else drops the handle's
+    chunks.  Handles may share a descriptor, so streams are kept by
+    handle.'''
+    sequential_reads = 2
+    chunk_size = 128 * 1024
+
+    def __init__(self, window, budget, workers=4):
+        self.window = window
+        self.budget = budget
+        self.used = 0
+        self.lock = Lock()
+        self.streams = {}
+        self.queue = Queue()
+        for i in range(workers):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    @staticmethod
+    def _size(chunk):
+        return Prefetcher.chunk_size if chunk is None else len(chunk)
+
+    def _drop(self, stream):
+        for chunk in stream.chunks.itervalues():
+            self.used -= self._size(chunk)
+        stream.chunks = {}
+
+    def read(self, path, handle, fd, size, offset):
+        '''Note a read of size bytes at offset through handle, which reads
+        from fd, and return the data if it has already been read ahead,
+        or None.'''
+        with self.lock:
+            stream = self.streams.get(handle)
+            if stream is None or stream.path != path:
+                stream = self.streams[handle] = _Stream(path, fd)
+            if offset == stream.next:
+                stream.run += 1
+            else:
+                self._drop(stream)
+                stream.run = 0
+                stream.ahead = offset + size
+            stream.next = offset + size
+            data = self._take(stream, size, offset)
+            if stream.run < self.sequential_reads:
+                return data
+            start = max(stream.ahead, offset + size)
+            start -= start % self.chunk_size
+            end = min(offset + size + self.window, stream.size)
+            while (start < end and
+                   self.used + self.chunk_size <= self.budget):
+                if start not in stream.chunks:
+                    stream.chunks[start] = None
+                    self.used += self.chunk_size
+                    self.queue.put((handle, stream, start))
+                start += self.chunk_size
+            advise, stream.ahead = stream.ahead < start, start
+        if advise and _fadvise is not None:
+            _fadvise(fd, offset + size, self.window, POSIX_FADV_WILLNEED)
+        return data
+
+    def _take(self, stream, size, offset):
+        '''Return size bytes at offset if they're all in stream's chunks,
+        discarding the chunks we've now read past.'''
+        for start in [start for start in stream.chunks
+                      if start + self.chunk_size <= offset]:
+            self.used -= self._size(stream.chunks.pop(start))
+        pieces = []
+        start = offset - offset % self.chunk_size
+        while size > 0:
+            chunk = stream.chunks.get(start)
+            if chunk is None:
+                return None
+            piece = chunk[offset - start:offset - start + size]
+            pieces.append(piece)
+            if len(chunk) < self.chunk_size:
+                break   # end of file
+            size -= len(piece)
+            offset += len(piece)
+            start += self.chunk_size
+        return ''.join(pieces)
+
+    def _work(self):
+        while True:
+            handle, stream, start = self.queue.get()
+            with self.lock:
+                wanted = self._pending(handle, stream, start)
+            if not wanted:
+                continue
+            try:
+                chunk = pread(stream.fd, self.chunk_size, start)
+            except OSError:
+                # Leave the gap, so the read falls back to pread and
+                # sees the error for itself.
+                chunk = None
+            with self.lock:
+                # A chunk dropped and scheduled again is queued twice;
+                # only the first read to finish fills it.
+                if self._pending(handle, stream, start):
+                    if chunk is None:
+                        del stream.chunks[start]
+                        self.used -= self.chunk_size
+                    else:
+                        stream.chunks[start] = chunk
+                        self.used += len(chunk) - self.chunk_size
+
+    def _pending(self, handle, stream, start):
+        return (self.streams.get(handle) is stream and
+                start in stream.chunks and stream.chunks[start] is None)
+
+    def forget(self, handle):
+        with self.lock:
+            stream = self.streams.pop(handle, None)
+            if stream is not None:
+                self._drop(stream)
+
+    def invalidate(self, path):
+        with self.lock:
+            for handle, stream in self.streams.items():
+                if stream.path == path:
+                    self._drop(stream)
+                    del self.streams[handle]
+
+    def clear(self):
+        with self.lock:
+            for stream in self.streams.itervalues():
+                self._drop(stream)
+            self.streams.clear()
+
+class Stats(object):
+    '''Counts calls, failures and latencies for each operation, along
+    with bytes transferred and reloads.'''
+    # Latencies go in buckets by powers of two microseconds; the last
+    # bucket takes everything from about half a minute up.
+    buckets = 26
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ops = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.reloads = 0
+        self.reload_seconds = 0.0
+        self.last_reload_seconds = 0.0
+        self.entries = 0
+        self.caches = {}    # name -> anything with counters()
+
+    def record(self, op, seconds, failed):
+        bucket = min(int(seconds * 1e6).bit_length(), self.buckets - 1)
+        with self.lock:
+            counts = self.ops.get(op)
+            if counts is None:
+                counts = self.ops[op] = { 'calls' : 0,
+                                          'errors' : 0,
+                                          'seconds' : 0.0,
+                                          'histogram' : [0] * self.buckets }
+            counts['calls'] += 1
+            counts['errors'] += failed
+            counts['seconds'] += seconds
+            counts['histogram'][bucket] += 1
+
+    def transferred(self, op, nbytes):
+        with self.lock:
+            if op == 'write':
+                self.bytes_written += nbytes
+            else:
+                self.bytes_read += nbytes
+
+    def reloaded(self, seconds, entries):
+        with self.lock:
+            self.reloads += 1
+            self.reload_seconds += seconds
+            self.last_reload_seconds = seconds
+            self.entries = entries
+
+    def snapshot(self):
+        '''Return a copy of all the statistics as a dict.'''
+        with self.lock:
+            ops = dict((op, dict(counts, histogram=list(counts['histogram'])))
+                       for op, counts in self.ops.iteritems())
+            return { 'ops' : ops,
+                     'bytes_read' : self.bytes_read,
+                     'bytes_written' : self.bytes_written,
+                     'reloads' : self.reloads,
+                     'reload_seconds' : self.reload_seconds,
+                     'last_reload_seconds' : self.last_reload_seconds,
+                     'entries' : self.entries,
+                     'caches' : dict((name, cache.counters())
+                                     for name, cache in self.caches.iteritems()),
+                     'max_rss_kb' : getrusage(RUSAGE_SELF).ru_maxrss }
+
+    @staticmethod
+    def _percentile(histogram, calls, fraction):
+        '''Return the upper bound, in microseconds, of the bucket holding
+        the given fraction of calls.'''
+        seen = 0
+        for bucket, n in enumerate(histogram):
+            seen += n
+            if seen >= fraction * calls:
+                return 1 << bucket
+        return 1 << len(histogram)
+
+    def report(self):
+        '''Return the statistics as text, one per line.'''
+        snap = self.snapshot()
+        lines = ['%s %s' % (key, snap[key]) for key in ('entries',
+                 'max_rss_kb', 'reloads', 'reload_seconds',
+                 'last_reload_seconds', 'bytes_read', 'bytes_written')]
+        for op, counts in sorted(snap['ops'].iteritems()):
+            calls, hist = counts['calls'], counts['histogram']
+            lines.append('op %s calls %d errors %d mean_us %.1f p50_us %d '
+                         'p90_us %d p99_us %d histogram %s'
+                         % (op, calls, counts['errors'],
+                            counts['seconds'] * 1e6 / calls,
+                            self._percentile(hist, calls, 0.5),
+                            self._percentile(hist, calls, 0.9),
+                            self._percentile(hist, calls, 0.99),
+                            ','.join(str(n) for n in hist)))
+        for name, counters in sorted(snap['caches'].iteritems()):
+            lookups = counters['hits'] + counters['misses']
+            counters['hit_rate'] = '%.3f' % (float(counters['hits']) / lookups
+                                             if lookups else 0)
+            lines.append('cache %s %s' % (name, ' '.join(
+                '%s %s' % item for item in sorted(counters.iteritems()))))
+        return '\n'.join(lines) + '\n'
+
+class StatsFS(Operations):
+    '''Serves a read-only directory holding one file, whose contents are
+    a Stats report as of when it was opened.'''
+    dirname = '/.mapperfs'
+    filename = dirname + '/stats'
+    paged_readdir = True
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.handles = count(1)
+        self.reports = {}
+        self.ctime = time.time()
+
+    def getattr(self, path, fi=None):
+        attrs = { 'st_atime' : self.ctime,
+                  'st_ctime' : self.ctime,
+                  'st_mtime' : self.ctime,
+                  'st_gid' : os.getegid(),
+                  'st_uid' : os.geteuid() }
+        if path == self.dirname:
+            attrs.update(st_mode=stat.S_IFDIR | 0o555, st_nlink=2, st_size=1)
+        elif path == self.filename:
+            attrs.update(st_mode=stat.S_IFREG | 0o444, st_nlink=1,
+                         st_size=len(self.stats.report()))
+        else:
+            raise FuseOSError(ENOENT)
+        return attrs
+
+    def access(self, path, mode):
+        self.getattr(path)
+        return -1 if (mode & os.W_OK) else 0
+
+    def open(self, path, fi):
+        if path != self.filename:
+            raise FuseOSError(ENOENT)
+        if fi.flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(EACCES)
+        fi.fh = next(self.handles)
+        # The size changes as we go, so don't let the kernel trust
+        # st_size or keep the pages.
+        fi.direct_io = 1
+        self.reports[fi.fh] = self.stats.report()
+        return 0
+
+    def read(self, path, size, offset, fi):
+        return self.reports[fi.fh][offset:offset + size]
+
+    def read_buf(self, path, size, offset, fi):
+        return self.read(path, size, offset, fi)
+
+    def readinto(self, path, buf, size, offset, fi):
+        data = self.read(path, size, offset, fi)
+        memmove(buf, data, len(data))
+        return len(data)
+
+    def release(self, path, fi):
+        self.reports.pop(fi.fh, None)
+
+    def readdir(self, path, fh, offset=0):
+        if path != self.dirname:
+            raise FuseOSError(ENOENT)
+        names = ['.', '..', os.path.basename(self.filename)]
+        return [(name, None, i + 1) for i, name in enumerate(names)][offset:]
 
 class WatcherThread(Thread):
-    def __init__(self, mapfuse, watch_files):
+    '''Rereads the list when a watched file changes.  Once a change
+    comes in, we wait out the rest of the quiet period, swallowing any
+    further changes, and then reload just once.'''
+    # How often to check whether we've been asked to stop
+    poll_interval = 1.0
+
+    def __init__(self, mapfuse, watch_files, quiet=0.5):
         super(WatcherThread, self).__init__()
+        self.daemon = True
         self.watch_files = watch_files
         self.mapfuse = mapfuse
-        
+        self.quiet = quiet
+        self.stopping = Event()
+
+    def stop(self):
+        self.stopping.set()
+
     def run(self):
         logging.debug('starting watcher thread')
-        mask = inotifyx.IN_MODIFY | inotifyx.IN_CLOSE_WRITE
+        # We watch the directories rather than the files themselves, so
+        # we still notice when an editor saves by renaming a new file
+        # over the old one.
+        mask = (inotifyx.IN_MODIFY | inotifyx.IN_CLOSE_WRITE |
+                inotifyx.IN_CREATE | inotifyx.IN_MOVED_TO)
         in_fd = inotifyx.init()
-        for f in self.watch_files:
-            inotifyx.add_watch(in_fd, f, mask)
-            logging.debug('watching ' + f)
-        while True:
-            logging.debug('watcher waiting for events')
-            inotifyx.get_events(in_fd)
-            logging.debug('watcher got change event')
-            self.mapfuse.read_list()
+        try:
+            dirs = {}
+            watched = set()
+            for f in self.watch_files:
+                d, base = os.path.split(os.path.abspath(f))
+                if d not in dirs:
+                    dirs[d] = inotifyx.add_watch(in_fd, d, mask)
+                watched.add((dirs[d], base))
+                logging.debug('watching ' + f)
+            while not self.stopping.is_set():
+                events = inotifyx.get_events(in_fd, self.poll_interval)
+                if not any((e.wd, e.name) in watched for e in events):
+                    continue
+                logging.debug('watcher got change event')
+                deadline = time.time() + self.quiet
+                while not self.stopping.is_set():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    inotifyx.get_events(in_fd, remaining)
+                if not self.stopping.is_set():
+                    try:
+                        self.mapfuse.read_list()
+                    except Exception:
+                        # Say an editor has the file half saved.  Keep
+                        # the old list, and try again on the next change.
+                        logging.exception('cannot reload the list')
+        finally:
+            os.close(in_fd)
+        logging.debug('watcher thread done')
+
+
+class BackingWatcher(Thread):
+    '''Watches the real files behind the mount, and tells the MapFuse to
+    forget what it has cached about any that change.  We watch the
+    directory holding each entry, and every directory inside mapped
+    directories, up to max_watches in all.  Anything beyond that is
+    left to the caches' own expiry.'''
+    poll_interval = 1.0
+
+    def __init__(self, mapfuse, max_watches):
+        super(BackingWatcher, self).__init__()
+        self.daemon = True
+        self.mapfuse = mapfuse
+        self.max_watches = max_watches
+        self.stopping = Event()
+        self.lock = Lock()
+        self.pending = None
+        self.in_fd = None
+        self.wds = {}           # wd -> directory
+        self.dirs = {}          # directory -> wd
+        self.recursive = set()  # wds whose new subdirectories get watched
+        self.complete = False   # whether every real path is watched
+
+    def stop(self):
+        self.stopping.set()
+
+    def sync(self, index):
+        '''Switch to watching the real paths in index.  The work is done
+        on the watcher thread.'''
+        with self.lock:
+            self.pending = index
+
+    def run(self):
+        logging.debug('starting backing watcher thread')
+        self.mask = (inotifyx.IN_MODIFY | inotifyx.IN_ATTRIB |
+                     inotifyx.IN_CLOSE_WRITE | inotifyx.IN_CREATE |
+                     inotifyx.IN_DELETE | inotifyx.IN_MOVED_FROM |
+                     inotifyx.IN_MOVED_TO | inotifyx.IN_DELETE_SELF |
+                     inotifyx.IN_MOVE_SELF)
+        self.in_fd = inotifyx.init()
+        try:
+            while not self.stopping.is_set():
+                with self.lock:
+                    index, self.pending = self.pending, None
+                if index is not None:
+                    self._rewatch(index)
+                for event in inotifyx.get_events(self.in_fd,
+                                                 self.poll_interval):
+                    self._handle(event)
+        finally:
+            os.close(self.in_fd)
+        logging.debug('backing watcher thread done')
+
+    def _watch(self, d, recursive):
+        if d in self.dirs:
+            wd = self.dirs[d]
+        else:
+            if len(self.dirs) >= self.max_watches:
+                return False
+            try:
+                wd = inotifyx.add_watch(self.in_fd, d, self.mask)
+            except (IOError, OSError), e:
+                logging.debug('cannot watch %s: %s' % (d, e))
+                return False
+            self.wds[wd] = d
+            self.dirs[d] = wd
+        if recursive:
+            self.recursive.add(wd)
+        return True
+
+    def _watch_tree(self, top):
+        complete = True
+        for d, subdirs, files in os.walk(top):
+            complete = self._watch(d, True) and complete
+        return complete
+
+    def _rewatch(self, index):
+        # Watching a directory that's already watched just hands back
+        # the same wd, so we can start over and then drop whatever is
+        # no longer wanted.
+        old = self.dirs
+        self.wds, self.dirs, self.recursive = {}, {}, set()
+        reals = [real for mounted, real in index.items()]
+        wanted = set(os.path.dirname(real) for real in reals)
+        # Carry on past failures, so we watch all we can.
+        complete = all([self._watch(d, False) for d in wanted] +
+                       [self._watch_tree(real) for real in reals
+                        if os.path.isdir(real)])
+        self.complete = complete
+        if not complete:
+            logging.warning('cannot watch every backing directory (the '
+                            'limit is %d); some changes to backing files '
+                            'will go unnoticed' % self.max_watches)
+        for d, wd in old.iteritems():
+            if d not in self.dirs:
+                try:
+                    inotifyx.rm_watch(self.in_fd, wd)
+                except (IOError, OSError):
+                    pass    # already gone
+        logging.debug('watching %d backing directories' % len(self.dirs))
+
+    def _handle(self, event):
+        if event.mask & inotifyx.IN_Q_OVERFLOW:
+            logging.debug('backing watcher overflowed')
+            self.mapfuse._invalidate_all()
+            return
+        d = self.wds.get(event.wd)
+        if d is None:
+            return
+        if event.mask & inotifyx.IN_IGNORED:
+            del self.wds[event.wd]
+            self.dirs.pop(d, None)
+            self.recursive.discard(event.wd)
+            self.complete = False
+            return
+        if event.mask & (inotifyx.IN_DELETE_SELF | inotifyx.IN_MOVE_SELF):
+            # Whatever takes its place isn't watched, and we don't know
+            # what we've cached from beneath it, so forget everything.
+            logging.debug('backing directory gone: %s', d)
+            self.complete = False
+            self.mapfuse._invalidate_all()
+            return
+        path = os.path.join(d, event.name) if event.name else d
+        logging.debug('backing change: %s', path)
+        self.mapfuse._invalidate(path)
+        if path != d:
+            self.mapfuse._invalidate(d)
+        if (event.wd in self.recursive and event.mask & inotifyx.IN_ISDIR
+            and event.mask & (inotifyx.IN_CREATE | inotifyx.IN_MOVED_TO)):
+            if not self._watch_tree(path):
+                self.complete = False
+
+
+def _copy(node):
+    if isinstance(node, Directory):
+        return node.copy()
+    entry = Entry('', dict(node.children) if node.children else None,
+                  node.isdir)
+    entry.prefix, entry.suffix = node.prefix, node.suffix
+    return entry
+
+class _TrieWriter(object):
+    '''Makes changes to a trie, keeping the Directory counts up to date
+    and stamping the ones whose contents change with now.
+
+    If shared is set, the trie's nodes may also belong to an older
+    Index.  Those are copied before they're changed, and the copies are
+    kept in fresh (by id) so that each node is copied at most once.'''
+    def __init__(self, root, now, shared):
+        self.root = root
+        self.now = now
+        self.fresh = {} if shared else None
+
+    def _put(self, node, name, child):
+        children = _children(node)
+        if children is None:
+            children = node.children = {}
+        old = children.get(name)
+        children[name] = child
+        if isinstance(node, Directory):
+            node.subdirs += (isinstance(child, Directory) -
+                             isinstance(old, Directory))
+            if old is None:
+                node.mtime = self.now
+        if self.fresh is not None:
+            self.fresh[id(child)] = child
+
+    def _pop(self, node, name):
+        old = _children(node).pop(name)
+        if isinstance(node, Directory):
+            node.subdirs -= isinstance(old, Directory)
+            node.mtime = self.now
+
+    def _child(self, node, name, create=False):
+        '''Return the child of node called name, ready to be modified.
+        If create is set, a missing child is created as a Directory.'''
+        children = _children(node)
+        child = children.get(name) if children else None
+        if child is None:
+            if not create:
+                return None
+            child = Directory(self.now)
+            name = _intern(name)
+        elif self.fresh is None or id(child) in self.fresh:
+            return child
+        else:
+            child = _copy(child)
+        self._put(node, name, child)
+        return child
+
+    def insert(self, names, real):
+        '''Map names (the components of a mounted path) to real.'''
+        node = self.root
+        for name in names[:-1]:
+            node = self._child(node, name, create=True)
+        entry = Entry(real)
+        if entry.suffix == names[-1]:
+            entry.suffix = names[-1]    # one string for both
+        old = (_children(node) or {}).get(names[-1])
+        if old is not None and _children(old):
+            # Keep whatever was already mapped beneath this name.
+            entry.children = dict(_children(old))
+        self._put(node, names[-1], entry)
+
+    def remove(self, names):
+        '''Unmap names, dropping any directories that leaves empty.'''
+        path = [self.root]
+        for name in names[:-1]:
+            node = self._child(path[-1], name)
+            if node is None:
+                return
+            path.append(node)
+        old = (_children(path[-1]) or {}).get(names[-1])
+        if old is None:
+            return
+        if _children(old):
+            # Other entries are still mapped beneath it.
+            self._put(path[-1], names[-1],
+                      Directory(self.now, _children(old)))
+            return
+        self._pop(path[-1], names[-1])
+        for i in range(len(names) - 1, 0, -1):
+            node = path[i]
+            if _children(node):
+                break
+            if isinstance(node, Entry):
+                node.children = None
+                break
+            self._pop(path[i - 1], names[i - 1])
+
+
+class Index(object):
+    '''One generation of the mapping: a trie of the entries, keyed on
+    path components.  The trie is all we keep; items() recovers the
+    entries from it.  An Index is never modified once built, so readers
+    can use it without locking.'''
+    def __init__(self, entries, root=None):
+        self.ctime = time.time()
+        if root is None:
+            writer = _TrieWriter(Directory(self.ctime), self.ctime, False)
+            for mounted, real in entries.iteritems():
+                names = _components(mounted)
+                if names:
+                    writer.insert(names, real)
+            root = writer.root
+        self.root = root
+
+    def updated(self, entries, removed, changed):
+        '''Return an Index for entries, given the mounted paths of ours it
+        no longer has and those it adds or maps differently.  Only the
+        nodes along those paths are copied; the rest of the trie is
+        shared with this Index.'''
+        writer = _TrieWriter(self.root.copy(), time.time(), True)
+        for mounted in removed:
+            names = _components(mounted)
+            if names:
+                writer.remove(names)
+        for mounted in changed:
+            names = _components(mounted)
+            if names:
+                writer.insert(names, entries[mounted])
+        return Index(entries, writer.root)
+
+    def items(self):
+        '''Yields the (mounted, real) pairs mapped in the trie.'''
+        stack = [('', self.root)]
+        while stack:
+            path, node = stack.pop()
+            if isinstance(node, Entry):
+                yield path, node.real
+            children = _children(node)
+            if children:
+                stack.extend((path + '/' + name, child)
+                             for name, child in children.iteritems())
+
+    def lookup(self, path):
+        '''Return the real path for a mounted path, or the Directory
+        node if it's one we synthesized.'''
+        node = self.root
+        names = _components(path)
+        for i, name in enumerate(names):
+            children = _children(node)
+            child = children.get(name) if children else None
+            if child is None:
+                # Perhaps it's under a directory we've exposed
+                if isinstance(node, Entry):
+                    real = node.real
+                    if os.path.isdir(real):
+                        right = os.path.join(*names[i:])
+                        logging.debug('  %s might contain %s', real, right)
+                        return os.path.join(real, right)
+                raise FuseOSError(ENOENT)
+            node = child
+        if isinstance(node, Entry):
+            real = node.real
+            logging.debug('  resolved %s to %s', path, real)
+            return real
+        logging.debug('  resolved %s to a directory', path)
+        return node
 
 
 class MapFuse(LoggingMixIn, Operations):
-    def __init__(self, pair_source, watch_files):
+    def __init__(self, pair_source, watch_files, attr_ttl=1.0,
+                 attr_cache_size=65536, entry_timeout=None,
+                 attr_timeout=None, negative_timeout=None, max_read=None,
+                 max_readahead=None, big_writes=False, reload_delay=0.5,
+                 watch_backing=False, max_watches=8192, stats=False,
+                 durability='fsync-on-fsync', max_open=64,
+                 prefetch_window=0, prefetch_budget=64 * 1024 * 1024,
+                 content_cache_size=0, content_cache_max_file=64 * 1024,
+                 mmap_limit=0, mmap_min_file=1024 * 1024):
+        '''Set attr_ttl to 0 to stat the real file on every getattr.
+        attr_cache_size bounds both the attribute cache and how many
+        opened files we remember, to set keep_cache on reopening.
+        With watch_backing, changes to the real files are noticed
+        through inotify (watching at most max_watches directories), so
+        attr_ttl can safely be long.
+
+        After a watched file changes, we wait reload_delay seconds for
+        more changes before rereading the list.
+
+        entry_timeout, attr_timeout, negative_timeout, max_read,
+        max_readahead and big_writes are passed to FUSE by
+        fuse_options(); those left as None get the FUSE defaults.
+
+        With stats, we keep a Stats in self.stats and serve its report
+        as /.mapperfs/stats.
+
+        durability is one of DURABILITY_POLICIES.
+
+        Up to max_open read-only descriptors for the real files are kept
+        open after use, to be shared by later opens of the same files.
+        Descriptors in use don't count against it.  Set it to 0 to open
+        and close the real file with every handle.  With watch_backing,
+        a pooled descriptor is trusted without statting its path, since
+        we hear when the file is replaced.
+
+        With a prefetch_window (in bytes), sequential reads are served
+        from a Prefetcher that reads that far ahead, holding at most
+        prefetch_budget bytes.  This helps with slow backing stores, but
+        it means reads go through Python rather than being spliced.
+
+        With a content_cache_size (in bytes), real files no bigger than
+        content_cache_max_file are kept in a ContentCache, and read-only
+        handles on them are served from memory.
+
+        With an mmap_limit (in bytes), read-only handles on real files
+        of at least mmap_min_file bytes read from FileMaps instead.  We
+        then leave read_buf out, so reads are copied straight from the
+        map into the kernel's buffer by readinto, rather than spliced.
+        A mapped file that shrinks under a read kills the filesystem, so
+        this is only safe for files that aren't modified in place.'''
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError('unknown durability policy: ' + durability)
+        self.durability = durability
         self.pair_source = pair_source
-        self.rwlock = Lock()
         self.update_lock = Lock()
         self.uid = os.geteuid()
         self.gid = os.getegid()
         self.watch_files = watch_files
+        self.reload_delay = reload_delay
+        self.watcher = None
+        self.backing_watcher = None
+        if watch_backing:
+            self.backing_watcher = BackingWatcher(self, max_watches)
+        self.file_pool = None
+        if max_open > 0:
+            self.file_pool = FilePool(max_open)
+        self.prefetcher = None
+        if prefetch_window > 0:
+            self.prefetcher = Prefetcher(prefetch_window, prefetch_budget)
+        self.attr_cache = None
+        if attr_ttl > 0:
+            self.attr_cache = AttrCache(attr_ttl, attr_cache_size)
+        self.content_cache = None
+        if content_cache_size > 0:
+            self.content_cache = ContentCache(content_cache_size,
+                                              content_cache_max_file)
+        self.file_maps = None
+        if mmap_limit > 0:
+            self.file_maps = FileMaps(mmap_limit, mmap_min_file,
+                                      self._backing_watched)
+            self.read_buf = None
+        # Handles on files served from the content cache or FileMaps
+        # aren't real descriptors, and handles sharing a pooled
+        # descriptor each need their own number, so number those where
+        # descriptors can't reach.
+        self.cached_handles = count(1 << 32)
+        self.contents = {}
+        self.mapped = {}
+        self.descriptors = {}   # handle -> pooled descriptor
+        self.kernel_options = { 'entry_timeout' : entry_timeout,
+                                'attr_timeout' : attr_timeout,
+                                'negative_timeout' : negative_timeout,
+                                'max_read' : max_read,
+                                'max_readahead' : max_readahead,
+                                'big_writes' : big_writes }
+        # The versions of the files most recently opened, so we can tell
+        # the kernel whether to keep their pages.
+        self.open_versions = OrderedDict()
+        self.open_versions_size = attr_cache_size
+        self.open_versions_lock = Lock()
+        self.dir_handles = count(1)
+        self.listings = {}
+        self.stats = None
+        self.stats_fs = None
+        if stats:
+            self.stats = Stats()
+            self.stats_fs = StatsFS(self.stats)
+            for name in ('attr', 'content'):
+                cache = getattr(self, name + '_cache')
+                if cache is not None:
+                    self.stats.caches[name] = cache
+        self.index = None
         self.read_list()
 
+    def fuse_options(self):
+        '''Return the keyword arguments to pass to FUSE along with this
+        MapFuse.'''
+        options = dict((key, value)
+                       for key, value in self.kernel_options.iteritems()
+                       if value is not None and value is not False)
+        # open needs the fuse_file_info to set keep_cache.
+        options['raw_fi'] = True
+        return options
+
+    def mount(self, mountpoint, **kwargs):
+        '''Mount at mountpoint, with fuse_options() along with any other
+        keyword arguments for FUSE, and return when it's unmounted.'''
+        options = self.fuse_options()
+        options.update(kwargs)
+        return FUSE(self, mountpoint, **options)
+
     def read_list(self):
-        entries = { mounted.rstrip('/'): real.rstrip('/')
-                    for (real, mounted) in self.pair_source() }
-        dirs = self._synthesize_dirs(entries)
-        logging.debug('init with: ' + str(entries))
+        # The lock only keeps reloads from racing each other.  Lookups
+        # just take whatever index is current; publishing a new one is a
+        # single reference assignment.
         with self.update_lock:
-            self.entries = entries
-            self.dirs = dirs
-        self.ctime = time.time()
+            start = time.time()
+            # Spell the mounted paths the way Index.items() will.
+            entries = { '/'.join([''] + _components(mounted)):
+                            real.rstrip('/')
+                        for (real, mounted) in self.pair_source() }
+            logging.debug('init with: %s', entries)
+            if self.index is None:
+                self.index = Index(entries)
+            else:
+                self._update_index(entries)
+            elapsed = time.time() - start
+            logging.info('indexed %d entries in %.3f seconds'
+                         % (len(entries), elapsed))
+            if self.stats is not None:
+                self.stats.reloaded(elapsed, len(entries))
+            self._invalidate_all()
+            if self.backing_watcher is not None:
+                self.backing_watcher.sync(self.index)
 
-    @staticmethod
-    def _synthesize_dirs(entries):
-        '''Return the directories needed to reach the entries in the form
-        { path : set(contents), ... }'''
-        dirs = defaultdict(Directory)
-        for e in entries:
-            d, base = os.path.split(e)
-            while d and base and not (d in entries or (d in dirs and base in dirs[d])):
-                dirs[d].add(base)
-                d, base = os.path.split(d)
-        logging.debug('dir tree: ' + str(dirs))
-        return dirs
+    def _update_index(self, entries):
+        '''Publish an index for entries, patching the current one rather
+        than building from scratch when the change is small.'''
+        old = dict(self.index.items())
+        removed = [mounted for mounted in old if mounted not in entries]
+        changed = [mounted for mounted, real in entries.iteritems()
+                   if old.get(mounted) != real]
+        added = sum(1 for mounted in changed if mounted not in old)
+        logging.info('reload: %d added, %d removed, %d changed'
+                     % (added, len(removed), len(changed) - added))
+        if len(removed) + len(changed) > len(entries) // 2:
+            self.index = Index(entries)
+        else:
+            self.index = self.index.updated(entries, removed, changed)
+
+    def _invalidate(self, path):
+        '''Forget anything cached about the real path.'''
+        if self.attr_cache is not None:
+            self.attr_cache.invalidate(path)
+        if self.file_pool is not None:
+            self.file_pool.invalidate(path)
+        if self.prefetcher is not None:
+            self.prefetcher.invalidate(path)
+        if self.content_cache is not None:
+            self.content_cache.invalidate(path)
+        if self.file_maps is not None:
+            self.file_maps.invalidate(path)
+
+    def _backing_watched(self):
+        '''Whether every change to a real path reaches _invalidate.'''
+        watcher = self.backing_watcher
+        return watcher is not None and watcher.complete
+
+    def _invalidate_all(self):
+        if self.attr_cache is not None:
+            self.attr_cache.clear()
+        if self.file_pool is not None:
+            self.file_pool.clear()
+        if self.prefetcher is not None:
+            self.prefetcher.clear()
+        if self.content_cache is not None:
+            self.content_cache.clear()
+        if self.file_maps is not None:
+            self.file_maps.clear()
+        with self.open_versions_lock:
+            self.open_versions.clear()
 
     def _find_referent(self, path):
-        logging.debug('lookup: ' + path)
-        with self.update_lock:
-            if path in self.entries:
-                logging.debug('  resolved %s to %s' % (path, self.entries[path]))
-                return self.entries[path]
-            if path in self.dirs:
-                logging.debug('  resolved %s to a directory' % path)
-                return self.dirs[path]
-            # Perhaps it's under a directory we've exposed
-            logging.debug('  could it be under a mounted directory?')
-            left, base = os.path.split(path)
-            right = base
-            while base and not (left in self.entries or left in self.dirs):
-                left, base = os.path.split(left)
-                right = os.path.join(base, right)
-            if left:
-                logging.debug('  found %s' % left)
-                if left in self.entries and os.path.isdir(self.entries[left]):
-                    logging.debug('  which might contain ' + right)
-                    return os.path.join(self.entries[left], right)
-            raise FuseOSError(ENOENT)
+        logging.debug('lookup: %s', path)
+        return self.index.lookup(path)
 
     def __call__(self, op, path, *args):
+        if self.stats is None:
+            return self._call(op, path, *args)
+        start = time.time()
+        try:
+            ret = self._call(op, path, *args)
+        except:
+            self.stats.record(op, time.time() - start, True)
+            raise
+        if isinstance(ret, GeneratorType):
+            # readdir does its work as FUSE goes through the entries
+            return self._timed_entries(op, start, ret)
+        self.stats.record(op, time.time() - start, False)
+        if op in ('read', 'read_buf') and ret is not None:
+            # read_buf may hand back a descriptor; count what was asked for
+            self.stats.transferred(op, len(ret) if isinstance(ret, basestring)
+                                       else args[0])
+        elif op in ('readinto', 'write'):
+            self.stats.transferred(op, ret)
+        return ret
+
+    def _timed_entries(self, op, start, entries):
+        '''Yield entries, recording op once they're done with.  FUSE
+        stops early when its buffer is full; that isn't a failure.'''
+        failed = False
+        try:
+            for entry in entries:
+                yield entry
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.stats.record(op, time.time() - start, failed)
+
+    def _call(self, op, path, *args):
+        if self.stats_fs is not None and (path == StatsFS.dirname or
+                path.startswith(StatsFS.dirname + '/')):
+            return self.stats_fs(op, path, *args)
         real_path = self._find_referent(path)
-        logging.debug('calling %s with %s (%s) %s' % (op, path, real_path, str(args)))
+        logging.debug('calling %s with %s (%s) %s', op, path, real_path, args)
         return Operations.__call__(self, op, real_path, *args)
 
     def noaccess(self, *args):
@@ -132,32 +1398,61 @@ class MapFuse(LoggingMixIn, Operations):
 
     def init(self, path):
         if self.watch_files:
-            watch_thread = WatcherThread(self, self.watch_files)
-            watch_thread.start()
+            self.watcher = WatcherThread(self, self.watch_files,
+                                         self.reload_delay)
+            self.watcher.start()
+        if self.backing_watcher is not None:
+            self.backing_watcher.start()
+
+    def destroy(self, path):
+        for watcher in (self.watcher, self.backing_watcher):
+            if watcher is not None:
+                watcher.stop()
+                watcher.join()
 
-    chmod = os.chmod
-    chown = os.chown
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+        self._invalidate(path)
+
+    def chown(self, path, uid, gid):
+        os.chown(path, uid, gid)
+        self._invalidate(path)
 
     create = noaccess
 
-    def flush(self, path, fh):
-        return os.fsync(fh)
+    def flush(self, path, fi):
+        # flush comes with every close(2), so we only sync here if we've
+        # been told to be strict, and never for read-only handles.
+        if (self.durability == 'strict' and
+            fi.flags & (os.O_WRONLY | os.O_RDWR)):
+            return os.fsync(self._fd(fi))
 
-    def fsync(self, path, datasync, fh):
-        return os.fsync(fh)
+    def fsync(self, path, datasync, fi):
+        if (self.durability == 'none' or fi.fh in self.contents or
+            fi.fh in self.mapped):
+            return
+        if datasync:
+            return _fdatasync(self._fd(fi))
+        return os.fsync(self._fd(fi))
 
-    def getattr(self, path, fh=None):
+    def getattr(self, path, fi=None):
         if not isinstance(path, Directory):
-            st = os.lstat(path)
-            return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+            cache = self.attr_cache
+            attrs = cache.get(path) if cache is not None else None
+            if attrs is None:
+                st = os.lstat(path)
+                attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                    'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+                if cache is not None:
+                    cache.put(path, attrs)
+            return attrs
         logging.debug('getattr of a directory')
-        return { 'st_atime' : self.ctime,
-                 'st_ctime' : self.ctime,
+        return { 'st_atime' : path.mtime,
+                 'st_ctime' : path.mtime,
                  'st_gid' : self.gid,
                  'st_mode' : stat.S_IFDIR | 0o555,
-                 'st_mtime' : self.ctime,
-                 'st_nlink' : 2 + path.num_subdirs(),
+                 'st_mtime' : path.mtime,
+                 'st_nlink' : path.nlink(),
                  'st_size' : len(path),
                  'st_uid' : self.uid }
 
@@ -168,22 +1463,170 @@ class MapFuse(LoggingMixIn, Operations):
     mkdir = noaccess
     mknod = noaccess
 
-    open = os.open
+    def open(self, path, fi):
+        if isinstance(fi, (int, long)):
+            raise TypeError('MapFuse needs raw_fi; mount it with mount()')
+        if (fi.flags & _WRITE_FLAGS or (self.file_pool is None and
+             self.content_cache is None and self.file_maps is None)):
+            fi.fh = os.open(path, fi.flags)
+            st = os.fstat(fi.fh)
+        else:
+            fd = None
+            if self.file_pool is not None and self._backing_watched():
+                # Replacing the file would have reached us through
+                # _invalidate, so a pooled descriptor is still good, and
+                # fstat spares us walking the path.
+                fd = self.file_pool.acquire(path, fi.flags)
+                st = os.fstat(fd)
+            else:
+                st = os.stat(path)
+            data = mapping = None
+            if self.content_cache is not None:
+                data = self._cached_content(path, st)
+            if data is None and self.file_maps is not None:
+                mapping = self.file_maps.acquire(path, st)
+            if data is not None or mapping is not None:
+                if fd is not None:
+                    self.file_pool.release(fd)
+                fi.fh = next(self.cached_handles)
+                if data is not None:
+                    self.contents[fi.fh] = data
+                else:
+                    self.mapped[fi.fh] = mapping
+            elif self.file_pool is not None:
+                if fd is None:
+                    fd = self.file_pool.acquire(path, fi.flags,
+                                                (st.st_dev, st.st_ino))
+                fi.fh = next(self.cached_handles)
+                self.descriptors[fi.fh] = fd
+            else:
+                fi.fh = os.open(path, fi.flags)
+        # If the file hasn't changed since it was last opened, whatever
+        # the kernel still has in its page cache is good.
+        version = (st.st_mtime, st.st_size)
+        with self.open_versions_lock:
+            fi.keep_cache = self.open_versions.pop(path, None) == version
+            self.open_versions[path] = version
+            if len(self.open_versions) > self.open_versions_size:
+                self.open_versions.popitem(last=False)
+        return 0
+
+    def _cached_content(self, path, st):
+        '''Return the contents of the real file path, whose stat is st,
+        from the content cache, reading them into it if need be.  Return
+        None for files too big to cache.'''
+        if (not stat.S_ISREG(st.st_mode) or
+            st.st_size > self.content_cache.max_size):
+            return None
+        version = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        data = self.content_cache.get(path, version)
+        if data is None:
+            # os rather than open(), so failures are OSErrors that FUSE
+            # passes on as they are.
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                data = os.read(fd, st.st_size + 1)
+            finally:
+                os.close(fd)
+            if len(data) != st.st_size:
+                return None     # changing as we read; don't trust it
+            self.content_cache.put(path, version, data)
+        return data
+
+    def _fd(self, fi):
+        '''Return the real descriptor behind fi's handle.'''
+        return self.descriptors.get(fi.fh, fi.fh)
+
+    def _from_memory(self, path, size, offset, fi):
+        data = self.contents.get(fi.fh)
+        if data is not None:
+            return data[offset:offset + size]
+        if self.prefetcher is not None:
+            return self.prefetcher.read(path, fi.fh, self._fd(fi), size,
+                                        offset)
+
+    def read(self, path, size, offset, fi):
+        mapping = self.mapped.get(fi.fh)
+        if mapping is not None:
+            return self.file_maps.read(mapping, size, offset)
+        data = self._from_memory(path, size, offset, fi)
+        if data is not None:
+            return data
+        return pread(self._fd(fi), size, offset)
+
+    def read_buf(self, path, size, offset, fi):
+        data = self._from_memory(path, size, offset, fi)
+        if data is not None:
+            return data
+        return self._fd(fi)
+
+    def readinto(self, path, buf, size, offset, fi):
+        mapping = self.mapped.get(fi.fh)
+        if mapping is not None:
+            return self.file_maps.readinto(mapping, buf, size, offset)
+        data = self._from_memory(path, size, offset, fi)
+        if data is not None:
+            memmove(buf, data, len(data))
+            return len(data)
+        return _check(_pread(self._fd(fi), buf, size, offset))
 
-    def read(self, path, size, offset, fh):
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.read(fh, size)
+    paged_readdir = True
 
-    def readdir(self, path, fh):
+    def opendir(self, path):
+        '''Returns a handle to a snapshot of the listing, so that readdir
+        can page through it with stable offsets.'''
+        fh = next(self.dir_handles)
+        self.listings[fh] = (path, self._list(path))
+        return fh
+
+    @staticmethod
+    def _list(path):
         if isinstance(path, Directory):
-            return ['.', '..'] + list(path)
+            return ['.', '..'] + path.keys()
         return ['.', '..'] + os.listdir(path)
 
+    def readdir(self, path, fh, offset=0):
+        path, names = self.listings.get(fh) or (path, self._list(path))
+        for i in xrange(offset, len(names)):
+            yield names[i], self._dirent_attrs(path, names[i]), i + 1
+
+    def _dirent_attrs(self, path, name):
+        '''Return the attributes of name in directory path, or None if
+        they aren't free: we only hand over synthesized directories and
+        whatever the attribute cache already holds, since statting every
+        entry of a big directory would cost more than it saves.'''
+        if name in ('.', '..'):
+            return None
+        if isinstance(path, Directory):
+            node = path[name]
+            if isinstance(node, Directory):
+                if node.entry_dirs is None:
+                    return None     # its link count isn't free yet
+                return self.getattr(node)
+            real = node.real
+        else:
+            real = os.path.join(path, name)
+        if self.attr_cache is None:
+            return None
+        return self.attr_cache.peek(real)
+
     readlink = os.readlink
 
-    def release(self, path, fh):
-        return os.close(fh)
+    def release(self, path, fi):
+        if self.contents.pop(fi.fh, None) is not None:
+            return
+        mapping = self.mapped.pop(fi.fh, None)
+        if mapping is not None:
+            return self.file_maps.release(mapping)
+        if self.prefetcher is not None:
+            self.prefetcher.forget(fi.fh)
+        fd = self.descriptors.pop(fi.fh, None)
+        if fd is not None:
+            return self.file_pool.release(fd)
+        return os.close(fi.fh)
+
+    def releasedir(self, path, fh):
+        self.listings.pop(fh, None)
 
     rename = noaccess
     rmdir = noaccess
@@ -207,17 +1650,20 @@ class MapFuse(LoggingMixIn, Operations):
 
     symlink = noaccess
 
-    def truncate(self, path, length, fh=None):
+    def truncate(self, path, length, fi=None):
         with open(path, 'r+') as f:
             f.truncate(length)
+        self._invalidate(path)
 
     unlink = noaccess
-    utimens = os.utime
+    def utimens(self, path, times=None):
+        os.utime(path, times)
+        self._invalidate(path)
 
-    def write(self, path, data, offset, fh):
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.write(fh, data)
+    def write(self, path, data, offset, fi):
+        written = pwrite(fi.fh, data, offset)
+        self._invalidate(path)
+        return written
 
 
 def listify(iterable):
@@ -226,98 +1672,503 @@ def listify(iterable):
         return iterable
     return list(iterable)
 
+# Mappers turn a list of files into (real, mounted) pairs with pairs().
+# Given the files along with how they differ from the files of the last
+# call, update() does the same, doing only as much work as the
+# differences need.
+
 class TrivialMapper:
     def pairs(self, files):
         for f in files:
             yield f, f
 
+    def update(self, files, added, removed):
+        return self.pairs(files)
+
+    def state(self):
+        return None
+
+    def restore(self, state):
+        pass
+
 class FlatMapper:
     fmt = '{base}-{n}{ext}'
 
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.names = {}             # file -> names it was given
+        self.taken = set()          # all the names given
+        self.flat = Counter()       # the files' names before renaming
+        self.reserved = set()       # names a rename mustn't use
+        self.next_n = {}
+
     def pairs(self, files):
-        files = listify(files)
-        flat = self._flat_with_collisions(files)
-        flat = self._uncollide(flat)
-        return izip(files, flat)
-    
+        self._reset()
+        return self.update(files, files, ())
+
+    def update(self, files, added, removed):
+        '''Files we've already named keep their names, so when a file is
+        added, the name it would have had in a fresh mount may already
+        belong to another.'''
+        for f in removed:
+            self._remove(f)
+        # We go through the files in the order received, renaming any
+        # that conflict with ones we've already named, but choosing the
+        # new names such that they don't preempt any actual files later
+        # in the list.  Sadly, this requires slurping up the whole list
+        # at the start, which is unlikely to be an actual problem for
+        # anyone, but it's nice when we can stick to O(1) generator
+        # chains.
+        added = listify(added)
+        flat = self._flat_with_collisions(added)
+        self.flat.update(flat)
+        self.reserved.update(flat)
+        for f, name in izip(added, flat):
+            if name in self.taken:
+                name = self._new_name(name, self.reserved, self.next_n)
+            self.names.setdefault(f, []).append(name)
+            self.taken.add(name)
+            self.reserved.add(name)
+        return ((f, name) for f, names in self.names.iteritems()
+                for name in names)
+
+    def state(self):
+        return (self.names, self.next_n)
+
+    def restore(self, state):
+        self._reset()
+        self.names, self.next_n = state
+        for f, names in self.names.iteritems():
+            self.taken.update(names)
+            self.flat[self._flat_with_collisions([f])[0]] += len(names)
+        self.reserved = self.taken | set(self.flat)
+
+    def _remove(self, f):
+        names = self.names.get(f)
+        if not names:
+            return
+        name = names.pop()
+        if not names:
+            del self.names[f]
+        self.taken.discard(name)
+        flat = self._flat_with_collisions([f])[0]
+        if name != flat:
+            self.next_n.pop(flat, None)    # a rename is free again
+        self.flat[flat] -= 1
+        if not self.flat[flat]:
+            del self.flat[flat]
+        for unused in (name, flat):
+            if unused not in self.taken and unused not in self.flat:
+                self.reserved.discard(unused)
+
     @staticmethod
     def _flat_with_collisions(files):
         return ['/' + os.path.basename(f.rstrip('/')) for f in files]
 
-    def _uncollide(self, files):
-        '''Yields files from input list, such that duplicate filenames
-        are renamed according to self.fmt.'''
-        # We'll go through the files in the order received, renaming any
-        # that conflict with ones we've already yielded, but choosing
-        # the new names such that they don't preempt any actual files
-        # later in the list.  Sadly, this requires slupring up the whole
-        # list at the start, which is unlikely to be an actual problem
-        # for anyone, but it's nice when we can stick to O(1) generator
-        # chains.
-        reserved = set(files)
-        yielded = set()
-        for f in files:
-            if f in yielded:
-                f = self._new_name(f, reserved)
-            yield f
-            yielded.add(f)
-            reserved.add(f)
-
-    def _new_name(self, filename, reserved):
+    def _new_name(self, filename, reserved, next_n):
+        '''Return the first name for filename, by self.fmt, that isn't
+        reserved.  next_n remembers where to start looking for each
+        filename; the names before that were all reserved when we passed
+        them, and _remove forgets the place if one of them is freed.'''
         base, ext = os.path.splitext(filename)
-        n = 1
+        n = next_n.get(filename, 1)
         while True:
             new_name = self.fmt.format(base=base, ext=ext, n=n)
             if new_name not in reserved:
+                next_n[filename] = n + 1
                 return new_name
             n += 1
 
 
 class CommonMapper:
+    def __init__(self):
+        self.prefix = None
+
+    def state(self):
+        return self.prefix
+
+    def restore(self, state):
+        self.prefix = state
+
     def pairs(self, files):
-        files = listify(files)
+        # We need two passes: one to find the prefix and one to trim it.
+        # If files can only be read once, we have to keep a copy.
+        if iter(files) is files:
+            files = listify(files)
         prefix = self._longest_common_path(files)
         logging.debug('longest common prefix: ' + prefix)
+        self.prefix = prefix if any(True for f in files) else None
+        return self._trimmed(files, prefix)
+
+    def update(self, files, added, removed):
+        '''The prefix only changes when something added lies outside
+        it.  It doesn't grow when files are removed, since that would
+        rename all the rest.'''
+        if self.prefix is None:
+            return self.pairs(files)
+        # Anything directly in the prefix has the prefix as its directory.
+        prefix = self._longest_common_path(chain([self.prefix + '/'], added))
+        if prefix != self.prefix:
+            logging.debug('longest common prefix: ' + prefix)
+            self.prefix = prefix
+        return self._trimmed(files, prefix)
+
+    @staticmethod
+    def _trimmed(files, prefix):
         prefix_len = len(prefix)
-        trimmed = (f[prefix_len:] for f in files)
-        return izip(files, trimmed)
+        return ((f, f[prefix_len:]) for f in files)
 
     @staticmethod
-    def _longest_common_path(file_list):
+    def _longest_common_path(files):
         '''Return the longest path that refers to a directory under
         which all the filenames can be found.  This is similar to
         os.path.commonprefix(), but the result is guaranteed to be a
-        directory, at least as implied by the filenames.
+        directory, at least as implied by the filenames.  We only hold
+        the prefix, so files can be streamed past.
         '''
-        prefix = os.path.commonprefix(file_list)
-        i = prefix.rfind('/')
-        if i == -1:  # not found!
-            return ''
-        return prefix[:i]
+        prefix = None
+        for f in files:
+            parts = f.split('/')[:-1]
+            if prefix is None:
+                prefix = parts
+                continue
+            for i, (ours, theirs) in enumerate(izip(prefix, parts)):
+                if ours != theirs:
+                    del prefix[i:]
+                    break
+            else:
+                del prefix[len(parts):]
+            if not prefix:
+                break
+        return '/'.join(prefix or [])
 
 
-def read_files(input_files):
-    '''Yields lines from input files, ignoring lines starting
-    with ; or # and removing surrounding quote marks.
+def clean_lines(lines):
+    '''Yields lines, ignoring lines starting with ; or # and
+    removing surrounding quote marks.
     '''
-    for line in fileinput.input(input_files):
+    for line in lines:
         line = line.strip(' \"\t\n')
         if not line.startswith('#') and not line.startswith(';'):
             yield line
 
+def read_files(input_files):
+    '''Yields lines from input files, ignoring lines starting
+    with ; or # and removing surrounding quote marks.
+    '''
+    return clean_lines(fileinput.input(input_files))
+
+def _read_input(name):
+    with open(name) as f:
+        return list(clean_lines(f))
+
+def _read_input_part(name, start, end):
+    '''Return the lines of name that start at or after byte start and
+    before byte end.'''
+    lines = []
+    with open(name) as f:
+        if start:
+            # The line that runs over start belongs to the part before
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        while start < end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+            start += len(line)
+    return list(clean_lines(lines))
+
+def _read_input_marshalled(part):
+    # A worker process sends back one marshalled string rather than a
+    # list, since that's far quicker to unpickle.
+    return marshal.dumps(_read_input_part(*part))
+
+# Input files are read in parts of at least this many bytes
+_MIN_PART = 1 << 20
+
+class InputFiles:
+    '''Reads lines from input files as read_files does, but remembers
+    each file's lines, so that rereading only rereads the files that
+    have changed.  Stdin is only read the first time.  With more than
+    one job, changed files are read in that many worker processes, and
+    big files are split between them.
+
+    The workers are started here, once, so make the InputFiles before
+    starting any threads (such as FUSE's): forking a process that has
+    other threads running is asking for deadlocks.'''
+    def __init__(self, names, jobs=1):
+        self.names = names
+        self.jobs = jobs
+        self.pool = Pool(jobs) if jobs > 1 else None
+        self.lines = {}
+        self.versions = {}
+        self.added = []
+        self.removed = []
+
+    def _stale(self):
+        '''Return an OrderedDict of the input files that have changed
+        since we read them, with their new versions.'''
+        stale = OrderedDict()
+        for name in self.names:
+            if name != '-':
+                st = os.stat(name)
+                version = (st.st_mtime, st.st_size, st.st_ino)
+                if self.versions.get(name) != version:
+                    stale[name] = version
+        return stale
+
+    def _load(self, names):
+        '''Return the lines of each of the files names, in order.'''
+        if self.pool is None:
+            return [_read_input(name) for name in names]
+        parts = []
+        for name in names:
+            size = os.path.getsize(name)
+            step = max(-(-size // self.jobs), _MIN_PART)
+            parts.append([(name, start, start + step)
+                          for start in xrange(0, size, step)] or
+                         [(name, 0, 0)])
+        if sum(len(file_parts) for file_parts in parts) <= 1:
+            return [_read_input(name) for name in names]
+        results = iter(self.pool.map(_read_input_marshalled,
+                                     [part for file_parts in parts
+                                      for part in file_parts]))
+        loaded = []
+        for file_parts in parts:
+            lines = []
+            for part in file_parts:
+                lines.extend(marshal.loads(next(results)))
+            loaded.append(lines)
+        return loaded
+
+    def close(self):
+        '''Stop the worker processes, if any.'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def read(self):
+        '''Return the lines of all the input files, in order, as a Lines
+        that can be gone through more than once.'''
+        old = [self.lines.get(name) for name in self.names]
+        if '-' in self.names and '-' not in self.lines:
+            self.lines['-'] = list(clean_lines(sys.stdin))
+        stale = self._stale()
+        for name, lines in izip(stale, self._load(stale.keys())):
+            logging.debug('read ' + name)
+            self.lines[name] = lines
+            self.versions[name] = stale[name]
+        new = [self.lines[name] for name in self.names]
+        for old_lines, new_lines in izip(old, new):
+            if old_lines is not new_lines:
+                added, removed = self._diff(old_lines or [], new_lines)
+                self.added.extend(added)
+                self.removed.extend(removed)
+        return Lines(new)
+
+    @staticmethod
+    def _diff(old, new):
+        '''Return the lines added to old and removed from it to make new,
+        the added ones in the order they come in new.'''
+        if not old:
+            return new, []
+        extra = Counter(new)
+        extra.subtract(old)
+        added = []
+        for line in new:
+            if extra[line] > 0:
+                added.append(line)
+                extra[line] -= 1
+        removed = [line for line, n in extra.iteritems()
+                   for i in xrange(-n)]
+        return added, removed
+
+    def state(self):
+        return (self.lines, self.versions)
+
+    def restore(self, state):
+        self.lines, self.versions = state
+        self.added, self.removed = [], []
+
+    def changes(self):
+        '''Return the lines added and removed by the reads since the last
+        call, as (added, removed).'''
+        changes = (self.added, self.removed)
+        self.added, self.removed = [], []
+        return changes
+
+class Lines:
+    '''The lines from several lists, in order.  Unlike a chain of
+    them, this can be iterated more than once.'''
+    def __init__(self, lists):
+        self.lists = lists
+
+    def __iter__(self):
+        for lines in self.lists:
+            for line in lines:
+                yield line
+
+class CompiledIndex:
+    '''Saves the pairs from pair_source in filename, along with the
+    state of the input files they came from, so that the next time
+    we're asked for pairs from the same inputs, we can load them rather
+    than reading and mapping all the inputs again.  key names anything
+    else the pairs depend on, such as the mapper.  An index made from
+    stdin is never trusted.
+
+    Anything in keep (such as the InputFiles and mapper behind
+    pair_source) has its state() saved along with the pairs, and is
+    restore()d from it when they're loaded, so that it can carry on
+    from where the saved pairs left off.'''
+    magic = 'mapperfs index 2'
+
+    def __init__(self, filename, pair_source, key, input_names, keep=()):
+        self.filename = filename
+        self.pair_source = pair_source
+        self.key = key
+        self.input_names = input_names
+        self.keep = keep
+        self.loaded = False
+
+    def _header(self):
+        if '-' in self.input_names:
+            return None
+        versions = []
+        for name in self.input_names:
+            st = os.stat(name)
+            versions.append((name, st.st_mtime, st.st_size, st.st_ino))
+        return (self.magic, self.key, versions)
+
+    def load(self):
+        '''Return the saved pairs, or None if they're missing or stale.'''
+        header = self._header()
+        if header is None:
+            return None
+        try:
+            with open(self.filename, 'rb') as f:
+                if marshal.load(f) != header:
+                    logging.info('index %s is stale' % self.filename)
+                    return None
+                reals, mounteds = marshal.load(f)
+                states = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError), e:
+            logging.info('cannot load index %s: %s' % (self.filename, e))
+            return None
+        for kept, state in izip(self.keep, states):
+            kept.restore(state)
+        return zip(reals, mounteds)
+
+    def save(self, pairs):
+        header = self._header()
+        if header is None:
+            return
+        temp = self.filename + '.tmp'
+        with open(temp, 'wb') as f:
+            marshal.dump(header, f)
+            marshal.dump(([real for real, mounted in pairs],
+                          [mounted for real, mounted in pairs]), f)
+            marshal.dump([kept.state() for kept in self.keep], f)
+        os.rename(temp, self.filename)
+
+    def pairs(self):
+        '''Return the pairs, from the saved index the first time if it's
+        fresh, and otherwise from pair_source, saving them.'''
+        if not self.loaded:
+            self.loaded = True
+            pairs = self.load()
+            if pairs is not None:
+                logging.info('loaded %d pairs from %s'
+                             % (len(pairs), self.filename))
+                return pairs
+        pairs = list(self.pair_source())
+        try:
+            self.save(pairs)
+        except (IOError, OSError), e:
+            logging.warning('cannot save index %s: %s' % (self.filename, e))
+        return pairs
+
+TUNING_OPTIONS = ('attr_ttl', 'entry_timeout', 'attr_timeout',
+                  'negative_timeout', 'max_read', 'max_readahead',
+                  'big_writes', 'reload_delay', 'watch_backing',
+                  'max_watches', 'stats', 'durability', 'max_open',
+                  'prefetch_window', 'prefetch_budget', 'content_cache_size',
+                  'content_cache_max_file', 'mmap_limit', 'mmap_min_file')
+
+def add_tuning_arguments(parser):
+    '''Add command line options for the MapFuse tuning knobs.'''
+    group = parser.add_argument_group('tuning')
+    group.add_argument('--attr-cache-ttl', dest='attr_ttl', type=float,
+                       default=1.0,
+                       help='seconds to cache file attributes (0 disables)')
+    group.add_argument('--entry-timeout', type=float,
+                       help='seconds the kernel caches name lookups')
+    group.add_argument('--attr-timeout', type=float,
+                       help='seconds the kernel caches file attributes')
+    group.add_argument('--negative-timeout', type=float,
+                       help='seconds the kernel caches failed lookups')
+    group.add_argument('--max-read', type=int,
+                       help='largest read request, in bytes')
+    group.add_argument('--max-readahead', type=int,
+                       help='most bytes the kernel reads ahead')
+    group.add_argument('--big-writes', action='store_true',
+                       help='allow write requests larger than 4k')
+    group.add_argument('--reload-delay', type=float, default=0.5,
+                       help="""seconds to wait for an input file to stop
+                       changing before rereading it""")
+    group.add_argument('--watch-backing', action='store_true',
+                       help="""watch the real files for changes, so that
+                       a long --attr-cache-ttl is safe""")
+    group.add_argument('--max-watches', type=int, default=8192,
+                       help='most directories to watch with --watch-backing')
+    group.add_argument('--durability', choices=DURABILITY_POLICIES,
+                       default='fsync-on-fsync',
+                       help="""when to sync writes to the real files:
+                       never, only on fsync, or also on every close of a
+                       file opened for writing""")
+    group.add_argument('--max-open', type=int, default=64,
+                       help="""most idle read-only descriptors for real
+                       files to keep open for reuse; those in use aren't
+                       limited (0 disables)""")
+    group.add_argument('--prefetch-window', type=int, default=0,
+                       help="""bytes to read ahead of sequential readers,
+                       for slow backing stores (0 disables)""")
+    group.add_argument('--prefetch-budget', type=int,
+                       default=64 * 1024 * 1024,
+                       help='most bytes to hold in read-ahead buffers')
+    group.add_argument('--content-cache-size', type=int, default=0,
+                       help="""bytes of small files' contents to keep in
+                       memory (0 disables)""")
+    group.add_argument('--content-cache-max-file', type=int,
+                       default=64 * 1024,
+                       help='largest file to keep in the content cache')
+    group.add_argument('--mmap-limit', type=int, default=0,
+                       help="""most bytes of large files to map into
+                       memory at once (0 disables); unsafe for files
+                       that are modified in place""")
+    group.add_argument('--mmap-min-file', type=int, default=1024 * 1024,
+                       help='smallest file to map into memory')
+    group.add_argument('--stats', action='store_true',
+                       help="""keep per-operation statistics, readable
+                       from .mapperfs/stats in the mount""")
+
+def tuning_options(args):
+    '''Return the MapFuse keyword arguments set by add_tuning_arguments.'''
+    return dict((name, getattr(args, name)) for name in TUNING_OPTIONS)
+
 def main():
     # I don't expect this command line application to be very useful.
     # It's more of a proof of concept and rough test.  The real value
     # will come from using this module in other code, where the files
     # and their visible mount points are based on something interesting.
 
-    # Note that you can specify both stdin and other input files, but
-    # if you do, you probably want to use --once.  Otherwise when a
-    # file changes, we'll throw away whatever we read from stdin the
-    # first time.  We could avoid this by keeping track of which files
-    # we got from each input source and only rereading the input file
-    # that changed.  But we don't do that, because it's complicated
-    # and probably not useful to anyone.
+    # Note that you can specify both stdin and other input files.
+    # Stdin is only read once.  When an input file changes, we reread
+    # just that file and combine it with what we already have from the
+    # others.
 
     mappers = {'copy': TrivialMapper,
                'flat': FlatMapper,
@@ -335,15 +2186,20 @@ def main():
                          rather than rereading them when they change''')
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to read input files with')
+    parser.add_argument('--index', metavar='FILE',
+                        help="""keep the mapped file list in FILE, and
+                        start from it when the input files haven't
+                        changed since""")
+    add_tuning_arguments(parser)
     parser.add_argument('mountpoint',
                         help='directory at which to mount the new filesystem')
     parser.add_argument('inputfile', nargs='+',
                         help="""File listing files, one per line, that
                         should exist in the new filesystem. - specifies
                         stdin.  (You can list stdin more than once, but
-                        you probably don't want to.  You can list both
-                        stdin and regular files, but if you do, you
-                        should probably also use --once.)""")
+                        you probably don't want to.)""")
 
     args = parser.parse_args()
 
@@ -355,10 +2211,23 @@ def main():
     logging.debug('Mounting to ' + args.mountpoint)
 
     mapper = mappers[args.mapper]()
-    pair_source = lambda: mapper.pairs(read_files(args.inputfile))
+    inputs = InputFiles(args.inputfile, args.jobs)
+
+    def pair_source():
+        files = inputs.read()
+        added, removed = inputs.changes()
+        return mapper.update(files, added, removed)
+
+    if args.index:
+        pair_source = CompiledIndex(args.index, pair_source, args.mapper,
+                                    args.inputfile, [inputs, mapper]).pairs
 
     watch = [] if args.once else [i for i in args.inputfile if i != '-']
-    fuse = FUSE(MapFuse(pair_source, watch), args.mountpoint, foreground=True)
+    try:
+        mapfuse = MapFuse(pair_source, watch, **tuning_options(args))
+        mapfuse.mount(args.mountpoint, foreground=True)
+    finally:
+        inputs.close()
     
 if __name__ == '__main__':
     main()
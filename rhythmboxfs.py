@@ -23,7 +23,7 @@ from xml.etree.cElementTree import ElementTree
 from urllib import unquote
 from urlparse import urlparse
 from mapperfs import MapFuse, TrivialMapper, FlatMapper, CommonMapper
-from fuse import FUSE
+from mapperfs import add_tuning_arguments, tuning_options
 
 def _playlist_files(pl):
     '''Return a list of files in the playlist, given the etree element
@@ -72,6 +72,7 @@ def main():
                         help='method of mapping filenames into the filesystem')
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('--debug', action='store_true')
+    add_tuning_arguments(parser)
     parser.add_argument('file', help='Rhythmbox playlist file')
     parser.add_argument('playlist', help='playlist name')
     parser.add_argument('mountpoint', help='target directory')
@@ -83,7 +84,8 @@ def main():
 
     mapper = mappers[args.mapper]()
     src = lambda: mapper.pairs(one_playlist(args.file, args.playlist))
-    fuse = FUSE(MapFuse(src, [args.file]), args.mountpoint, foreground=True)
+    mapfuse = MapFuse(src, [args.file], **tuning_options(args))
+    mapfuse.mount(args.mountpoint, foreground=True)
 
 
 if __name__ == '__main__':